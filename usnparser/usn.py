@@ -23,13 +23,17 @@ __date__ = '15 July 2022'
 __description__ = 'Python 3 script to parse the NTFS USN Journal'
 
 
+import io
 import os
-import sys
-import json
+import re
+import mmap
 import struct
 import collections
 from argparse import ArgumentParser
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from json.encoder import encode_basestring
+from datetime import datetime, timedelta
 
 
 reasons = collections.OrderedDict()
@@ -53,8 +57,8 @@ reasons[0x40000] = 'ENCRYPTION_CHANGE'
 reasons[0x80000] = 'OBJECT_ID_CHANGE'
 reasons[0x100000] = 'REPARSE_POINT_CHANGE'
 reasons[0x200000] = 'STREAM_CHANGE'
-reasons[0x800000] = 'INTEGRITY_CHANGE'
 reasons[0x00400000] = 'TRANSACTED_CHANGE'
+reasons[0x800000] = 'INTEGRITY_CHANGE'
 reasons[0x80000000] = 'CLOSE'
 
 
@@ -84,97 +88,196 @@ sourceInfo[0x2] = 'AUXILIARY_DATA'
 sourceInfo[0x4] = 'REPLICATION_MANAGEMENT'
 sourceInfo[0x8] = 'CLIENT_REPLICATION_MANAGEMENT'
 
+nullRun = re.compile(b'\x00*')
+zeroBlock = bytes(4096)
+filetimeEpoch = datetime(1601, 1, 1)
+recordLengthStruct = struct.Struct('<I')
+recordStruct = struct.Struct('<2H4Q4I2H')
+unpackRecordLength = recordLengthStruct.unpack_from
+unpackRecord = recordStruct.unpack_from
+recordHeaderSize = recordLengthStruct.size + recordStruct.size
+outputBufferSize = 1 << 20
+verboseTemplate = """{{
+    "filename": {filename},
+    "humanTimestamp": {humanTimestamp},
+    "timestamp": "{timestamp}",
+    "epochTimestamp": {epochTimestamp},
+    "usn": {usn},
+    "fileReferenceNumber": {fileReferenceNumber},
+    "parentFileReferenceNumber": {parentFileReferenceNumber},
+    "reason": "{reason}",
+    "fileAttributes": "{fileAttributes}",
+    "mftSeqNumber": {mftSeqNumber},
+    "mftEntryNumber": {mftEntryNumber},
+    "pMftSeqNumber": {pMftSeqNumber},
+    "pMftEntryNumber": {pMftEntryNumber},
+    "filenameLength": {filenameLength},
+    "filenameOffset": {filenameOffset},
+    "sourceInfo": {sourceInfo},
+    "securityId": {securityId},
+    "majorVersion": {majorVersion},
+    "minorVersion": {minorVersion}
+}}
+"""
+
 
-def parseUsn(infile, usn):
-    recordProperties = [
-        'majorVersion',
-        'minorVersion',
-        'fileReferenceNumber',
-        'parentFileReferenceNumber',
-        'usn',
-        'timestamp',
-        'reason',
-        'sourceInfo',
-        'securityId',
-        'fileAttributes',
-        'filenameLength',
-        'filenameOffset'
-    ]
-    recordDict = dict(zip(recordProperties, usn))
-    recordDict['filename'] = filenameHandler(infile, recordDict)
-    recordDict['reason'] = convertAttributes(reasons, recordDict['reason'])
-    recordDict['fileAttributes'] = convertAttributes(
-        attributes, recordDict['fileAttributes'])
-    recordDict['humanTimestamp'] = filetimeToHumanReadable(
-        recordDict['timestamp'])
-    recordDict['epochTimestamp'] = filetimeToEpoch(recordDict['timestamp'])
-    recordDict['timestamp'] = f"{recordDict['timestamp']:016x}"
-    recordDict['mftSeqNumber'], recordDict['mftEntryNumber'] = convertFileReference(
-        recordDict['fileReferenceNumber'])
-    recordDict['pMftSeqNumber'], recordDict['pMftEntryNumber'] = convertFileReference(
-        recordDict['parentFileReferenceNumber'])
-    reorder = [
-        'filename',
-        'humanTimestamp',
-        'timestamp',
-        'epochTimestamp',
-        'usn',
-        'fileReferenceNumber',
-        'parentFileReferenceNumber',
-        'reason',
-        'fileAttributes',
-        'mftSeqNumber',
-        'mftEntryNumber',
-        'pMftSeqNumber',
-        'pMftEntryNumber',
-        'filenameLength',
-        'filenameOffset',
-        'sourceInfo',
-        'securityId',
-        'majorVersion',
-        'minorVersion'
-    ]
-    recordDict = {key: recordDict[key] for key in reorder}
-    return recordDict
-
-
-def findFirstRecord(infile):
+def parseUsn(usn, filename):
+    """
+    Returns every USN property of a record as a JSON object (--verbose),
+    written straight from the record fields rather than through a dict
+    and json.dumps
+    """
+    (majorVersion, minorVersion, fileReferenceNumber, parentFileReferenceNumber,
+     usnNumber, timestamp, reason, source, securityId, fileAttributes,
+     filenameLength, filenameOffset) = usn
+    humanTimestamp = filetimeToHumanReadable(timestamp)
+    mftSeqNumber, mftEntryNumber = convertFileReference(fileReferenceNumber)
+    pMftSeqNumber, pMftEntryNumber = convertFileReference(
+        parentFileReferenceNumber)
+    return verboseTemplate.format(
+        filename=encode_basestring(filenameHandler(filename)),
+        humanTimestamp='null' if humanTimestamp is None else f'"{humanTimestamp}"',
+        timestamp=timestamp.to_bytes(8, 'big').hex(),
+        epochTimestamp=filetimeToEpoch(timestamp),
+        usn=usnNumber,
+        fileReferenceNumber=fileReferenceNumber,
+        parentFileReferenceNumber=parentFileReferenceNumber,
+        reason=convertReason(reason),
+        fileAttributes=convertFileAttributes(fileAttributes),
+        mftSeqNumber=mftSeqNumber,
+        mftEntryNumber=mftEntryNumber,
+        pMftSeqNumber=pMftSeqNumber,
+        pMftEntryNumber=pMftEntryNumber,
+        filenameLength=filenameLength,
+        filenameOffset=filenameOffset,
+        sourceInfo=source,
+        securityId=securityId,
+        majorVersion=majorVersion,
+        minorVersion=minorVersion)
+
+
+def parseUsnMinimal(usn, filename):
+    """
+    Returns only the fields used by the default, CSV, TLN and body formats:
+    (humanTimestamp, epochTimestamp, filename, reason, fileAttributes,
+    mftEntryNumber, mftSeqNumber)
+    """
+    mftSeqNumber, mftEntryNumber = convertFileReference(usn[2])
+    return (filetimeToHumanReadable(usn[5]),
+            filetimeToEpoch(usn[5]),
+            filenameHandler(filename),
+            convertReason(usn[6]),
+            convertFileAttributes(usn[9]),
+            mftEntryNumber,
+            mftSeqNumber)
+
+
+def mapJournal(infile):
+    """
+    Memory-map the journal read-only, so records are unpacked straight out
+    of the page cache, and hint to the kernel that it will be read
+    sequentially where supported. An empty file can't be mapped, so an
+    empty bytes object stands in for it.
+    """
+    if not os.fstat(infile.fileno()).st_size:
+        return b''
+    journal = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        journal.madvise(mmap.MADV_SEQUENTIAL)
+    return journal
+
+
+def findFirstRecord(journal):
     """
     Returns a pointer to the first USN record found
     Modified version of Dave Lassalle's 'parseusn.py'
     https://github.com/sans-dfir/sift-files/blob/master/scripts/parseusn.py
     """
-    while True:
-        data = infile.read(65536).lstrip(b'\x00')
-        if data:
-            return infile.tell() - len(data)
+    return nullRun.match(journal, skipZeroBlocks(journal, 0)).end()
+
+
+def skipZeroBlocks(journal, pos):
+    """
+    Returns the offset of the first block of zeroBlock's size at or after
+    pos which isn't entirely null. Sparse regions of the journal are
+    compared a block at a time rather than scanned byte by byte.
+    """
+    while journal[pos:pos + len(zeroBlock)] == zeroBlock:
+        pos += len(zeroBlock)
+    return pos
 
 
-def findNextRecord(infile, journalSize):
+def findNextRecord(journal, pos):
     """
     There are runs of null bytes between USN records. I'm guessing
     this is done to ensure that journal records are cluster-aligned on disk.
-    This function reads through these null bytes, returning an offset
-    to the first byte of the the next USN record.
+    This function skips over these null bytes a whole zero block at a time,
+    finishing the tail with a regex match, and returns the offset of the
+    first non-null dword, which starts the next USN record, or None once
+    the end of the journal is reached.
+    """
+    nonNull = nullRun.match(journal, skipZeroBlocks(journal, pos)).end()
+    pos += (nonNull - pos) & ~3
+    if pos + 4 > len(journal):
+        return None
+    return pos
+
+
+def readRecords(journal, pos, stop=None):
+    """
+    Generator over the USN records in the journal starting at or after pos,
+    and before stop if given. Each record is unpacked in place, yielding the
+    record fields and raw filename bytes.
     """
-    while True:
-        try:
-            recordLength = struct.unpack_from('<I', infile.read(4))[0]
-            if recordLength:
-                infile.seek(-4, 1)
-                return infile.tell() + recordLength
-        except struct.error:
-            if infile.tell() >= journalSize:
-                sys.exit()
+    end = len(journal)
+    if stop is None:
+        stop = end
+    while pos < stop and pos + recordHeaderSize <= end:
+        recordLength = unpackRecordLength(journal, pos)[0]
+        if not recordLength:
+            pos = findNextRecord(journal, pos)
+            if pos is None:
+                return
+            continue
+        usn = unpackRecord(journal, pos + recordLengthStruct.size)
+        filenameStart = pos + recordHeaderSize
+        filenameEnd = filenameStart + usn[10]
+        if filenameEnd > end:
+            return
+        yield usn, journal[filenameStart:filenameEnd]
+        pos += recordLength
+
+
+def splitJournal(journal, pos, count):
+    """
+    Walks only the record lengths to find record boundaries, returning up to
+    count (start, stop) ranges of roughly equal size, each beginning on a
+    record, for readRecords to work through independently
+    """
+    end = len(journal)
+    step = max((end - pos) // count, 1)
+    starts = [pos]
+    while pos + recordHeaderSize <= end:
+        recordLength = unpackRecordLength(journal, pos)[0]
+        if not recordLength:
+            pos = findNextRecord(journal, pos)
+            if pos is None:
+                break
+            continue
+        if pos >= starts[-1] + step:
+            starts.append(pos)
+        pos += recordLength
+    return list(zip(starts, starts[1:] + [end]))
 
 
 def filetimeToHumanReadable(filetime):
     """
-    Borrowed from Willi Ballenthin's parse_usnjrnl.py
+    Converts FILETIME (100ns intervals since 1601-01-01) to a UTC date string
+    using integer arithmetic
     """
     try:
-        return str(datetime.utcfromtimestamp(float(filetime) * 1e-7 - 11644473600))
-    except ValueError:
+        return str(filetimeEpoch + timedelta(microseconds=filetime // 10))
+    except OverflowError:
         pass
 
 
@@ -182,46 +285,130 @@ def filetimeToEpoch(filetime):
     """
     Converts to Epoch Timestamp with milliseconds
     """
-    return int(filetime / 10000 - 11644473600000)
+    return filetime // 10000 - 11644473600000
 
 
 def convertFileReference(buf):
     """
-    Read, store, unpack, and return FileReference
+    Split a FileReference into its sequence number (upper 16 bits)
+    and MFT entry number (lower 48 bits)
     """
-    b = memoryview(bytearray(struct.pack("<Q", buf)))
-    seq = struct.unpack_from("<h", b[6:8])[0]
-
-    b = memoryview(bytearray(b[0:6]))
-    byteString = ''
+    return (buf >> 48) & 0xFFFF, buf & 0x0000FFFFFFFFFFFF
 
-    for i in b[::-1]:
-        byteString += format(i, 'x')
-    entry = int(byteString, 16)
 
-    return seq, entry
+def filenameHandler(filename):
+    """
+    Decode and return filename
+    """
+    return filename.decode('utf-16-le', 'replace')
 
 
-def filenameHandler(infile, recordDict):
+def namesByBit(attributeType):
     """
-    Read and return filename
+    Returns the names of a mask table in a list indexed by bit position
     """
-    try:
-        filename = struct.unpack_from('<{}s'.format(
-            recordDict['filenameLength']), infile.read(recordDict['filenameLength']))[0]
-        return filename.decode('utf16')
-    except struct.error:
-        return ''
+    bitNames = [None] * 32
+    for mask, name in attributeType.items():
+        bitNames[mask.bit_length() - 1] = name
+    return bitNames
 
 
-def convertAttributes(attributeType, data):
+def convertAttributes(bitNames, data):
     """
-    Identify attributes and return list
+    Identify attributes and return list, visiting only the bits set in data
+    and indexing their names by bit position
     """
-    attributeList = [attributeType[i] for i in attributeType if i & data]
+    attributeList = []
+    while data:
+        bit = data & -data
+        name = bitNames[bit.bit_length() - 1]
+        if name:
+            attributeList.append(name)
+        data ^= bit
     return ' '.join(attributeList)
 
 
+def cachedConversion(attributeType):
+    """
+    Returns a memoized convertAttributes for a single table. A journal only
+    holds a handful of distinct masks, so nearly every lookup is a cache hit.
+    """
+    bitNames = namesByBit(attributeType)
+    cache = {}
+
+    def convert(data):
+        names = cache.get(data)
+        if names is None:
+            names = cache[data] = convertAttributes(bitNames, data)
+        return names
+    return convert
+
+
+convertReason = cachedConversion(reasons)
+convertFileAttributes = cachedConversion(attributes)
+
+
+def lineFormatter(args):
+    """
+    Returns a function formatting the output of parseUsnMinimal as a line
+    in the selected output format, so the format is chosen once rather than
+    once per record
+    """
+    if args.csv:
+        return '{0},{2},{4},{3}\n'.format
+    if args.body:
+        def formatBody(humanTimestamp, epochTimestamp, filename, reason,
+                       fileAttributes, mftEntryNumber, mftSeqNumber):
+            return '0|{0} (USN: {1})|{2}-{3}|0|0|0|0|{4}|{4}|{4}|{4}\n'.format(
+                filename,
+                reason,
+                mftEntryNumber,
+                mftSeqNumber,
+                epochTimestamp // 1000)
+        return formatBody
+    if args.tln:
+        system = (args.system or '').replace('{', '{{').replace('}', '}}')
+        return ('{1}|USN|' + system + '||{2};{3}\n').format
+    return '{0} | {2} | {4} | {3}\n'.format
+
+
+def recordFormatter(args):
+    """
+    Returns a function formatting an unpacked record and its filename bytes
+    in the selected output format, chosen once for the whole journal
+    """
+    if args.verbose and not (args.csv or args.body or args.tln):
+        return parseUsn
+    formatLine = lineFormatter(args)
+
+    def formatRecord(usn, filename):
+        return formatLine(*parseUsnMinimal(usn, filename))
+    return formatRecord
+
+
+def writeRecords(journal, start, stop, args, o):
+    """
+    Writes the records between offsets start and stop to o in the selected
+    output format
+    """
+    formatRecord = recordFormatter(args)
+    write = o.write
+    for recordData, filename in readRecords(journal, start, stop):
+        write(formatRecord(recordData, filename).encode(
+            'utf8', errors='backslashreplace'))
+
+
+def parseJournalRange(path, start, stop, args):
+    """
+    Worker for --jobs: maps the journal and returns the formatted output
+    for the records between offsets start and stop
+    """
+    output = io.BytesIO()
+    with open(path, 'rb') as infile:
+        writeRecords(mapJournal(infile), start, stop, args, output)
+    return output.getvalue()
+
+
 def main():
     """
     Main function for argument parsing and function execution
@@ -249,87 +436,29 @@ def main():
     p.add_argument('-V', '--verbose',
                    help='Return all USN properties for each record (JSON only)',
                    action='store_true')
+    p.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                   help='Parse the journal with N worker processes')
     p.add_argument('-v', '--version', action='version', version=p.description)
     args = p.parse_args()
+    if args.jobs < 1:
+        p.error('--jobs must be at least 1')
 
-    journalSize = os.path.getsize(args.file)
-    with open(args.file, 'rb') as i:
-        with open(args.outfile, 'wb') as o:
-            i.seek(findFirstRecord(i))
+    with open(args.file, 'rb') as infile:
+        with open(args.outfile, 'wb', buffering=outputBufferSize) as o:
+            journal = mapJournal(infile)
+            start = findFirstRecord(journal)
 
             if args.csv:
                 o.write(b'timestamp,filename,fileattr,reason\n')
-                while True:
-                    nextRecord = findNextRecord(i, journalSize)
-                    recordLength = struct.unpack_from('<I', i.read(4))[0]
-                    recordData = struct.unpack_from('<2H4Q4I2H', i.read(56))
-                    u = parseUsn(i, recordData)
-                    u = '{0},{1},{2},{3}\n'.format(
-                        u['humanTimestamp'],
-                        u['filename'],
-                        u['fileAttributes'],
-                        u['reason'])
-                    o.write(u.encode('utf8', errors='backslashreplace'))
-                    i.seek(nextRecord)
-
-            elif args.body:
-                while True:
-                    nextRecord = findNextRecord(i, journalSize)
-                    recordLength = struct.unpack_from('<I', i.read(4))[0]
-                    recordData = struct.unpack_from('<2H4Q4I2H', i.read(56))
-                    u = parseUsn(i, recordData)
-                    u = '0|{0} (USN: {1})|{2}-{3}|0|0|0|0|{4}|{4}|{4}|{4}\n'.format(
-                        u['filename'],
-                        u['reason'],
-                        u['mftEntryNumber'],
-                        u['mftSeqNumber'],
-                        int(u['epochTimestamp'] / 1000),
-                        int(u['epochTimestamp'] / 1000),
-                        int(u['epochTimestamp'] / 1000),
-                        int(u['epochTimestamp'] / 1000))
-                    o.write(u.encode('utf8', errors='backslashreplace'))
-                    i.seek(nextRecord)
-
-            elif args.tln:
-                if not args.system:
-                    args.system = ''
-                while True:
-                    nextRecord = findNextRecord(i, journalSize)
-                    recordLength = struct.unpack_from('<I', i.read(4))[0]
-                    recordData = struct.unpack_from('<2H4Q4I2H', i.read(56))
-                    u = parseUsn(i, recordData)
-                    u = '{0}|USN|{1}||{2};{3}\n'.format(
-                        u['epochTimestamp'],
-                        args.system,
-                        u['filename'],
-                        u['reason'])
-                    o.write(u.encode('utf8', errors='backslashreplace'))
-                    i.seek(nextRecord)
-
-            elif args.verbose:
-                while True:
-                    nextRecord = findNextRecord(i, journalSize)
-                    recordLength = struct.unpack_from('<I', i.read(4))[0]
-                    recordData = struct.unpack_from('<2H4Q4I2H', i.read(56))
-                    u = json.dumps(parseUsn(i, recordData),
-                                   indent=4, ensure_ascii=False)
-                    o.write(u.encode('utf8', errors='backslashreplace'))
-                    o.write(b'\n')
-                    i.seek(nextRecord)
 
+            if args.jobs > 1:
+                starts, stops = zip(*splitJournal(journal, start, args.jobs * 4))
+                with ProcessPoolExecutor(args.jobs) as executor:
+                    for output in executor.map(parseJournalRange, repeat(args.file),
+                                               starts, stops, repeat(args)):
+                        o.write(output)
             else:
-                while True:
-                    nextRecord = findNextRecord(i, journalSize)
-                    recordLength = struct.unpack_from('<I', i.read(4))[0]
-                    recordData = struct.unpack_from('<2H4Q4I2H', i.read(56))
-                    u = parseUsn(i, recordData)
-                    u = '{0} | {1} | {2} | {3}\n'.format(
-                        u['humanTimestamp'],
-                        u['filename'],
-                        u['fileAttributes'],
-                        u['reason'])
-                    o.write(u.encode('utf8', errors='backslashreplace'))
-                    i.seek(nextRecord)
+                writeRecords(journal, start, None, args, o)
 
 
 if __name__ == '__main__':